@@ -1,12 +1,15 @@
 import pandas as pd
 import requests
 import os
+import shutil
 from urllib.parse import urlparse
 import time
 from datetime import datetime
 from pathlib import Path
 import concurrent.futures
+import functools
 import threading
+from collections import Counter
 from typing import List, Dict, Tuple, Optional
 import logging
 from datetime import datetime
@@ -15,7 +18,7 @@ from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from PIL import Image
 import pillow_heif
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, convert_from_bytes
 import tempfile
 
 # Configuración de logging
@@ -42,12 +45,115 @@ def setup_logging(log_folder: str = "logs") -> logging.Logger:
     
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
-    
+
     return logger
 
+# Tabla de traducción precompilada para clean_filename:
+# acentos → versión ASCII y caracteres inválidos para nombres de archivo → '_'
+_FILENAME_TRANSLATION = str.maketrans({
+    'ó': 'o', 'ú': 'u', 'í': 'i', 'á': 'a', 'é': 'e',
+    'ñ': 'n', 'ü': 'u', 'Ó': 'O', 'Ú': 'U', 'Í': 'I',
+    'Á': 'A', 'É': 'E', 'Ñ': 'N', 'Ü': 'U',
+    **{char: '_' for char in '<>:"/\\|?*'}
+})
+
+def _conversion_worker_init():
+    """Inicializa cada proceso worker de conversión registrando el plugin HEIF"""
+    try:
+        pillow_heif.register_heif_opener()
+    except Exception:
+        pass
+
+def _convert_file_to_jpg(file_path: str) -> Tuple[str, Optional[str]]:
+    """
+    Convierte un archivo HEIC o PDF descargado a JPG y elimina el original.
+    Se ejecuta en un proceso worker del pool de conversión.
+    Retorna (ruta_original, None) en éxito o (ruta_original, error) en fallo.
+    """
+    file_ext = os.path.splitext(file_path)[1].lower()
+    jpg_path = f"{os.path.splitext(file_path)[0]}.jpg"
+
+    try:
+        if file_ext == '.heic':
+            with Image.open(file_path) as image:
+                # Convertir a RGB si es necesario
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                # Guardar como JPG con buena calidad
+                image.save(jpg_path, 'JPEG', quality=90, optimize=True)
+
+        elif file_ext == '.pdf':
+            # pdftoppm -jpeg escribe el JPG directo (primera página),
+            # sin re-encodear con PIL
+            paths = convert_from_path(
+                file_path,
+                dpi=150,
+                first_page=1,
+                last_page=1,
+                fmt='jpeg',
+                jpegopt={'quality': 90},
+                output_folder=os.path.dirname(jpg_path),
+                output_file=os.path.splitext(os.path.basename(jpg_path))[0],
+                single_file=True,
+                paths_only=True
+            )
+
+            if not paths:
+                return file_path, "no se pudieron extraer imágenes del PDF"
+
+            if paths[0] != jpg_path:
+                os.replace(paths[0], jpg_path)
+
+        else:
+            # Nada que convertir
+            return file_path, None
+
+        # Eliminar archivo original
+        os.remove(file_path)
+        return file_path, None
+
+    except Exception as e:
+        return file_path, str(e)
+
+def _convert_pdf_bytes_to_jpg(data: bytes, jpg_path: str) -> Tuple[str, Optional[str]]:
+    """
+    Convierte un PDF recibido en memoria a JPG sin pasarlo por disco.
+    Se ejecuta en un proceso worker del pool de conversión.
+    Retorna (ruta_jpg, None) en éxito o (ruta_jpg, error) en fallo.
+    """
+    try:
+        # pdftoppm -jpeg escribe el JPG directo, sin re-encodear con PIL
+        paths = convert_from_bytes(
+            data,
+            dpi=150,
+            first_page=1,
+            last_page=1,
+            fmt='jpeg',
+            jpegopt={'quality': 90},
+            output_folder=os.path.dirname(jpg_path),
+            output_file=os.path.splitext(os.path.basename(jpg_path))[0],
+            single_file=True,
+            paths_only=True
+        )
+
+        if not paths:
+            return jpg_path, "no se pudieron extraer imágenes del PDF"
+
+        if paths[0] != jpg_path:
+            os.replace(paths[0], jpg_path)
+        return jpg_path, None
+
+    except Exception as e:
+        return jpg_path, str(e)
+
 class EvidenciasDownloader:
     def __init__(self, max_workers: int = 5, max_retries: int = 3, timeout: int = 30, convert_files: bool = True):
-        self.max_workers = max_workers
+        # Las descargas son I/O-bound: conviene tener más hilos que núcleos,
+        # pero acotados a la máquina real (mismo criterio que el default de
+        # ThreadPoolExecutor) para no sobresuscribir contenedores chicos
+        cpu_count = os.cpu_count() or 1
+        self.max_workers = max(1, min(max_workers, cpu_count * 4, 32))
         self.max_retries = max_retries
         self.timeout = timeout
         self.convert_files = convert_files
@@ -61,6 +167,9 @@ class EvidenciasDownloader:
             'conversion_failed': 0
         }
         self.lock = threading.Lock()
+        # Único estado compartido entre corridas (la instancia vive lo que
+        # vive el proceso); todo lo demás es local a cada corrida
+        self._conversion_pool = None
         
         # Registrar plugin HEIF para PIL
         if self.convert_files:
@@ -97,32 +206,26 @@ class EvidenciasDownloader:
                     backoff_factor=1
                 )
         
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        # Dimensionar el pool de conexiones según los hilos de descarga para
+        # evitar el warning "Connection pool is full" y reconexiones extra
+        adapter = HTTPAdapter(
+            max_retries=retry_strategy,
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers
+        )
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
 
     def clean_filename(self, filename: str) -> str:
         """Limpia caracteres especiales del nombre de archivo"""
-        if not filename or pd.isna(filename):
+        # Los llamadores ya filtran nulos con máscaras notna; aquí basta un
+        # chequeo barato (NaN != NaN) sin pasar por pandas en cada valor
+        if filename is None or filename != filename or filename == '':
             return "archivo_sin_nombre"
         
-        filename = str(filename)
-        
-        # Reemplaza caracteres especiales por versiones ASCII
-        replacements = {
-            'ó': 'o', 'ú': 'u', 'í': 'i', 'á': 'a', 'é': 'e',
-            'ñ': 'n', 'ü': 'u', 'Ó': 'O', 'Ú': 'U', 'Í': 'I',
-            'Á': 'A', 'É': 'E', 'Ñ': 'N', 'Ü': 'U'
-        }
-        
-        for old, new in replacements.items():
-            filename = filename.replace(old, new)
-        
-        # Remueve caracteres no válidos para nombres de archivo
-        invalid_chars = '<>:"/\\|?*'
-        for char in invalid_chars:
-            filename = filename.replace(char, '_')
-        
+        # Una sola pasada con la tabla precompilada
+        filename = str(filename).translate(_FILENAME_TRANSLATION)
+
         # Limitar longitud del nombre
         if len(filename) > 200:
             filename = filename[:200]
@@ -131,7 +234,7 @@ class EvidenciasDownloader:
 
     def get_file_extension(self, url: str) -> str:
         """Obtiene la extensión del archivo desde la URL"""
-        if not url or pd.isna(url):
+        if not url or url != url:
             return ""
         
         try:
@@ -149,227 +252,358 @@ class EvidenciasDownloader:
         
         return ""
 
-    def convert_heic_to_jpg(self, input_path: str, output_path: str) -> bool:
-        """Convierte archivo HEIC a JPG"""
-        try:
-            # Abrir imagen HEIC
-            with Image.open(input_path) as image:
-                # Convertir a RGB si es necesario
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                # Guardar como JPG con buena calidad
-                image.save(output_path, 'JPEG', quality=90, optimize=True)
-            
-            self.logger.info(f"🔄 HEIC convertido a JPG: {os.path.basename(output_path)}")
-            return True
-            
-        except Exception as e:
-            self.logger.error(f"❌ Error convirtiendo HEIC {input_path}: {e}")
-            return False
+    def schedule_conversion(self, file_path: str, run: Dict) -> None:
+        """
+        Encola la conversión HEIC/PDF → JPG en el pool de procesos,
+        sin bloquear al hilo de descarga que la solicita.
+        """
+        if not self.convert_files or self._conversion_pool is None:
+            return
+
+        file_ext = os.path.splitext(file_path)[1].lower()
+        if file_ext == '.heic':
+            # Los HEIC se acumulan y se convierten en un solo lote
+            # (una llamada map al pool) cuando terminan las descargas
+            run['pending_heic'].append(file_path)
+        elif file_ext == '.pdf':
+            future = self._conversion_pool.submit(_convert_file_to_jpg, file_path)
+            run['futures'].append(future)
+
+    def _write_download(self, response, folder_path: str, file_path: str) -> int:
+        """
+        Escribe la respuesta de forma atómica en file_path y retorna los bytes escritos.
+        En Linux usa O_TMPFILE + link, de modo que el archivo anónimo nunca
+        crea una entrada temporal en el directorio; en otros sistemas (o si el
+        filesystem no soporta O_TMPFILE) cae al esquema clásico .tmp + rename.
+        """
+        response.raw.decode_content = True
+
+        if hasattr(os, 'O_TMPFILE'):
+            try:
+                fd = os.open(folder_path, os.O_TMPFILE | os.O_RDWR, 0o644)
+            except OSError:
+                fd = None
+
+            if fd is not None:
+                try:
+                    with os.fdopen(fd, 'wb', closefd=False) as f:
+                        shutil.copyfileobj(response.raw, f)
+                    size = os.fstat(fd).st_size
+                    if size > 0:
+                        try:
+                            # linkat sobre /proc materializa el inodo anónimo
+                            if os.path.exists(file_path):
+                                os.remove(file_path)
+                            os.link(f"/proc/self/fd/{fd}", file_path)
+                        except OSError:
+                            # Filesystem sin soporte para enlazar O_TMPFILE:
+                            # copiar desde el descriptor al destino final
+                            os.lseek(fd, 0, os.SEEK_SET)
+                            with open(file_path, 'wb') as out:
+                                while True:
+                                    chunk = os.read(fd, shutil.COPY_BUFSIZE)
+                                    if not chunk:
+                                        break
+                                    out.write(chunk)
+                    return size
+                finally:
+                    os.close(fd)
+
+        # Fallback: archivo temporal visible + rename atómico
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, 'wb') as f:
+            shutil.copyfileobj(response.raw, f)
+            size = f.tell()
+
+        if size == 0:
+            os.remove(temp_path)
+            return 0
+
+        os.rename(temp_path, file_path)
+        return size
 
-    def convert_pdf_to_jpg(self, input_path: str, output_folder: str, base_filename: str) -> bool:
-        """Convierte archivo PDF a JPG (primera página o todas las páginas)"""
+    def _ensure_conversion_pool(self):
+        """Crea (una sola vez) el pool de procesos de conversión compartido"""
+        with self.lock:
+            if self._conversion_pool is None and self.convert_files:
+                self._conversion_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=os.cpu_count() or 1,
+                    initializer=_conversion_worker_init
+                )
+            return self._conversion_pool
+
+    def close(self) -> None:
+        """Libera el pool de conversión compartido (llamar al apagar el servicio)"""
+        if self._conversion_pool is not None:
+            self._conversion_pool.shutdown()
+            self._conversion_pool = None
+
+    def _remote_size(self, url: str) -> Optional[int]:
+        """Consulta el Content-Length remoto con una petición HEAD ligera"""
         try:
-            # Convertir PDF a imágenes
-            images = convert_from_path(
-                input_path,
-                dpi=200,  # Buena calidad
-                first_page=1,
-                last_page=1
-            )
-            
-            if images:
-                # Guardar primera página como JPG
-                output_path = os.path.join(output_folder, f"{base_filename}.jpg")
-                images[0].save(output_path, 'JPEG', quality=90, optimize=True)
-                
-                self.logger.info(f"🔄 PDF convertido a JPG: {os.path.basename(output_path)}")
-                return True
-            else:
-                self.logger.error(f"❌ No se pudieron extraer imágenes del PDF: {input_path}")
-                return False
-                
-        except Exception as e:
-            self.logger.error(f"❌ Error convirtiendo PDF {input_path}: {e}")
-            return False
+            response = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            return int(length) if length is not None else None
+        except (requests.exceptions.RequestException, ValueError):
+            return None
 
-    def post_process_file(self, file_path: str) -> Optional[str]:
-        """Post-procesa el archivo descargado (conversiones)"""
-        if not self.convert_files:
-            return file_path
-        
-        file_ext = os.path.splitext(file_path)[1].lower()
-        base_path = os.path.splitext(file_path)[0]
-        folder_path = os.path.dirname(file_path)
-        base_filename = os.path.splitext(os.path.basename(file_path))[0]
-        
+    def _materialize_duplicate(self, primary: Dict, task: Dict) -> Counter:
+        """
+        Crea el destino adicional de una URL ya descargada mediante enlace
+        duro (o copia si el sistema de archivos no lo permite). Si el
+        original terminó convertido a JPG, el duplicado también se
+        materializa como JPG con su propio nombre base.
+        """
+        stats = Counter()
+        src_base = os.path.splitext(primary['filename'])[0]
+        dst_base = os.path.splitext(task['filename'])[0]
+
+        # El original se borra al convertirse, así que de estos dos pares
+        # existe a lo sumo uno como fuente
+        candidates = [
+            (os.path.join(primary['folder_path'], primary['filename']),
+             os.path.join(task['folder_path'], task['filename'])),
+            (os.path.join(primary['folder_path'], f"{src_base}.jpg"),
+             os.path.join(task['folder_path'], f"{dst_base}.jpg")),
+        ]
+
+        for source, destination in candidates:
+            if not os.path.exists(source):
+                continue
+            # Fila literalmente repetida o destino ya presente: nada que hacer
+            if source == destination or os.path.exists(destination):
+                stats['skipped'] += 1
+                return stats
+            try:
+                os.makedirs(task['folder_path'], exist_ok=True)
+                try:
+                    os.link(source, destination)
+                except OSError:
+                    shutil.copyfile(source, destination)
+                self.logger.info(f"🔗 Destino repetido materializado: {os.path.basename(destination)}")
+                stats['successful'] += 1
+            except OSError as e:
+                self.logger.error(f"❌ Error materializando {destination}: {e}")
+                stats['failed'] += 1
+            return stats
+
+        # La descarga primaria falló (o era la misma ruta): no hay fuente
+        stats['failed'] += 1
+        return stats
+
+    def _snapshot_folder(self, folder_path: str) -> Dict[str, int]:
+        """Toma una foto única del contenido de una carpeta (nombre → tamaño)"""
+        snapshot = {}
         try:
-            if file_ext == '.heic':
-                # Convertir HEIC a JPG
-                jpg_path = f"{base_path}.jpg"
-                if self.convert_heic_to_jpg(file_path, jpg_path):
-                    # Eliminar archivo original HEIC
-                    os.remove(file_path)
-                    with self.lock:
-                        self.download_stats['converted'] += 1
-                    return jpg_path
-                else:
-                    with self.lock:
-                        self.download_stats['conversion_failed'] += 1
-                    return file_path
-            
-            elif file_ext == '.pdf':
-                # Convertir PDF a JPG
-                jpg_path = f"{base_path}.jpg"
-                if self.convert_pdf_to_jpg(file_path, folder_path, base_filename):
-                    # Eliminar archivo original PDF
-                    os.remove(file_path)
-                    with self.lock:
-                        self.download_stats['converted'] += 1
-                    return jpg_path
-                else:
-                    with self.lock:
-                        self.download_stats['conversion_failed'] += 1
-                    return file_path
-            
-            return file_path
-            
-        except Exception as e:
-            self.logger.error(f"❌ Error en post-procesamiento de {file_path}: {e}")
-            with self.lock:
-                self.download_stats['conversion_failed'] += 1
-            return file_path
-
-    def download_single_file(self, url: str, filename: str, folder_path: str) -> bool:
-        """Descarga un archivo individual y lo post-procesa si es necesario"""
-        if not url or pd.isna(url):
-            return False
-        
+            with os.scandir(folder_path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        snapshot[entry.name] = entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def download_single_file(self, url: str, filename: str, folder_path: str, run: Dict) -> Counter:
+        """
+        Descarga un archivo individual y lo post-procesa si es necesario.
+        `run` es el contexto local de la corrida (snapshots, conversiones
+        pendientes): nada por-corrida vive en la instancia compartida.
+        Retorna un contador local de estadísticas que el hilo coordinador
+        fusiona al final (evita tomar self.lock en cada operación).
+        """
+        stats = Counter()
+
+        if not url or url != url:
+            stats['failed'] += 1
+            return stats
+
         try:
             # Verificar si el archivo final (posiblemente convertido) ya existe
             base_filename = os.path.splitext(filename)[0]
             original_ext = os.path.splitext(filename)[1].lower()
-            
+
+            # Foto de carpeta tomada antes del despacho: evita stat() por archivo
+            existing_files = run['snapshots'].get(folder_path, {})
+
             # Si el archivo original es HEIC o PDF, verificar si ya existe la versión JPG
             if self.convert_files and original_ext in ['.heic', '.pdf']:
                 jpg_filename = f"{base_filename}.jpg"
-                jpg_path = os.path.join(folder_path, jpg_filename)
-                if os.path.exists(jpg_path) and os.path.getsize(jpg_path) > 0:
+                if existing_files.get(jpg_filename, 0) > 0:
                     self.logger.info(f"⏭️ Archivo convertido ya existe: {jpg_filename}")
-                    with self.lock:
-                        self.download_stats['skipped'] += 1
-                    return True
-            
+                    stats['skipped'] += 1
+                    return stats
+
             # Verificar archivo original
             file_path = os.path.join(folder_path, filename)
-            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                # Si no necesita conversión, está listo
+            local_size = existing_files.get(filename, 0)
+            if local_size > 0:
+                # Si no necesita conversión, cotejar contra el Content-Length
+                # remoto (HEAD) antes de dar la descarga por buena
                 if not self.convert_files or original_ext not in ['.heic', '.pdf']:
-                    self.logger.info(f"⏭️ Archivo ya existe: {filename}")
-                    with self.lock:
-                        self.download_stats['skipped'] += 1
-                    return True
-            
-            # Crear carpeta si no existe
-            os.makedirs(folder_path, exist_ok=True)
-            
+                    remote_size = self._remote_size(url)
+                    if remote_size is None or remote_size == local_size:
+                        self.logger.info(f"⏭️ Archivo ya existe: {filename}")
+                        stats['skipped'] += 1
+                        return stats
+                    self.logger.info(f"🔁 Tamaño local ({local_size}) ≠ remoto ({remote_size}), re-descargando: {filename}")
+
+            # Crear carpeta solo la primera vez que se ve; con varios archivos
+            # por sesión esto ahorra un makedirs por descarga
+            if folder_path not in run['known_folders']:
+                os.makedirs(folder_path, exist_ok=True)
+                run['known_folders'].add(folder_path)
+
             # Realizar descarga
             response = self.session.get(url, stream=True, timeout=self.timeout)
             response.raise_for_status()
-            
-            # Escribir archivo temporal
-            temp_path = f"{file_path}.tmp"
-            with open(temp_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            
-            # Verificar descarga exitosa
-            if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+
+            # Los PDFs que van a convertirse se mantienen en memoria y se
+            # entregan directo a convert_from_bytes, sin escribir el PDF a disco
+            if self.convert_files and original_ext == '.pdf' and self._conversion_pool is not None:
+                data = response.content
+                if not data:
+                    self.logger.error(f"❌ Descarga falló: {filename}")
+                    stats['failed'] += 1
+                    return stats
+
+                jpg_path = os.path.join(folder_path, f"{base_filename}.jpg")
+                future = self._conversion_pool.submit(_convert_pdf_bytes_to_jpg, data, jpg_path)
+                run['futures'].append(future)
+
+                self.logger.info(f"✅ Descargado en memoria: {filename} ({len(data)} bytes)")
+                stats['successful'] += 1
+                return stats
+
+            # Escribir de forma atómica (O_TMPFILE + link en Linux)
+            size = self._write_download(response, folder_path, file_path)
+            if size == 0:
                 self.logger.error(f"❌ Descarga falló: {filename}")
-                with self.lock:
-                    self.download_stats['failed'] += 1
-                return False
-            
-            # Mover archivo temporal a ubicación final
-            os.rename(temp_path, file_path)
-            
-            self.logger.info(f"✅ Descargado: {filename} ({os.path.getsize(file_path)} bytes)")
-            
-            # Post-procesar archivo (conversiones)
-            final_path = self.post_process_file(file_path)
-            
-            with self.lock:
-                self.download_stats['successful'] += 1
-            return True
-            
+                stats['failed'] += 1
+                return stats
+
+            self.logger.info(f"✅ Descargado: {filename} ({size} bytes)")
+
+            # Encolar conversión (si aplica) en el pool de procesos
+            self.schedule_conversion(file_path, run)
+
+            stats['successful'] += 1
+            return stats
+
         except requests.exceptions.RequestException as e:
             self.logger.error(f"❌ Error de conexión descargando {filename}: {e}")
-            with self.lock:
-                self.download_stats['failed'] += 1
-            return False
+            stats['failed'] += 1
+            return stats
         except Exception as e:
             self.logger.error(f"❌ Error inesperado con {filename}: {e}")
-            with self.lock:
-                self.download_stats['failed'] += 1
-            return False
+            stats['failed'] += 1
+            return stats
 
     def prepare_download_tasks(self, df: pd.DataFrame, output_folder: str) -> List[Dict]:
-        """Prepara las tareas de descarga desde el DataFrame"""
+        """Prepara las tareas de descarga desde el DataFrame (vectorizado, sin iterrows)"""
         tasks = []
-        
-        for index, row in df.iterrows():
-            # Extraer información básica
-            grupo = str(row.get('Código del grupo', 'Sin_grupo')) if pd.notna(row.get('Código del grupo')) else "Sin_grupo"
-            sesion = str(row.get('Sesión', 'Sin_sesion')) if pd.notna(row.get('Sesión')) else f"Sesion_{index+1}"
-            
-            # Limpiar nombres
-            grupo = self.clean_filename(grupo)
-            sesion = self.clean_filename(sesion)
-            
-            # Crear carpeta para este grupo
-            session_folder = os.path.join(output_folder, grupo)
-            
-            # Definir tipos de archivos a procesar
-            file_types = [
-                ('Archivo asistencia', 'asistencia'),
-                ('Archivo foto inicial', 'foto_inicial'),
-                ('Archivo foto final', 'foto_final')
-            ]
-            
-            for column_name, file_type in file_types:
-                if column_name in row and pd.notna(row[column_name]):
-                    url = str(row[column_name]).strip()
-                    if url:
-                        ext = self.get_file_extension(url)
-                        filename = f"{sesion}_{file_type}{ext}"
-                        
-                        task = {
-                            'url': url,
-                            'filename': filename,
-                            'folder_path': session_folder,
-                            'grupo': grupo,
-                            'sesion': sesion,
-                            'tipo': file_type
-                        }
-                        tasks.append(task)
-                        
-                        with self.lock:
-                            self.download_stats['total'] += 1
-        
+
+        if df.empty:
+            return tasks
+
+        # Columna de grupo vectorizada con valor por defecto
+        if 'Código del grupo' in df.columns:
+            grupos = df['Código del grupo'].astype(str).where(df['Código del grupo'].notna(), 'Sin_grupo')
+        else:
+            grupos = pd.Series('Sin_grupo', index=df.index)
+
+        # Columna de sesión con relleno posicional para valores faltantes
+        defaults = pd.Series([f"Sesion_{i+1}" for i in range(len(df))], index=df.index)
+        if 'Sesión' in df.columns:
+            sesiones = df['Sesión'].astype(str).where(df['Sesión'].notna(), defaults)
+        else:
+            sesiones = defaults
+
+        # Limpiar nombres y resolver carpetas de una sola pasada
+        grupos = grupos.map(self.clean_filename)
+        sesiones = sesiones.map(self.clean_filename)
+        carpetas = grupos.map(lambda grupo: os.path.join(output_folder, grupo))
+
+        # Definir tipos de archivos a procesar
+        file_types = [
+            ('Archivo asistencia', 'asistencia'),
+            ('Archivo foto inicial', 'foto_inicial'),
+            ('Archivo foto final', 'foto_final')
+        ]
+
+        for column_name, file_type in file_types:
+            if column_name not in df.columns:
+                continue
+
+            # Filtrar URLs válidas con operaciones de columna
+            urls = df[column_name][df[column_name].notna()].astype(str).str.strip()
+            urls = urls[urls != '']
+
+            for index, url in zip(urls.index, urls.to_numpy()):
+                ext = self.get_file_extension(url)
+                sesion = sesiones.loc[index]
+
+                task = {
+                    'url': url,
+                    'filename': f"{sesion}_{file_type}{ext}",
+                    'folder_path': carpetas.loc[index],
+                    'grupo': grupos.loc[index],
+                    'sesion': sesion,
+                    'tipo': file_type
+                }
+                tasks.append(task)
+
         return tasks
 
-    def download_with_threads(self, tasks: List[Dict]) -> None:
-        """Ejecuta las descargas usando ThreadPoolExecutor"""
+    def download_with_threads(self, tasks: List[Dict]) -> Counter:
+        """
+        Ejecuta las descargas usando ThreadPoolExecutor.
+        Retorna las estadísticas de ESTA corrida; self.download_stats solo
+        acumula el total histórico del proceso.
+        """
         if not tasks:
             self.logger.warning("No hay tareas de descarga para ejecutar")
-            return
-        
+            return Counter()
+
         self.logger.info(f"🚀 Iniciando descarga de {len(tasks)} archivos con {self.max_workers} hilos")
-        
+
+        # Agrupar por URL antes del despacho: la misma evidencia
+        # referenciada desde varias filas se descarga una sola vez y los
+        # destinos adicionales se materializan después por enlace duro
+        primary_by_url = {}
+        unique_tasks = []
+        duplicate_tasks = []
+        for task in tasks:
+            primary = primary_by_url.get(task['url'])
+            if primary is None:
+                primary_by_url[task['url']] = task
+                unique_tasks.append(task)
+            else:
+                duplicate_tasks.append((primary, task))
+
+        merged_stats = Counter(total=len(tasks))
+
+        if duplicate_tasks:
+            self.logger.info(f"🔗 {len(duplicate_tasks)} destinos repetidos se enlazarán tras la descarga")
+            tasks = unique_tasks
+
+        # Contexto local de la corrida: snapshots de carpeta, conversiones
+        # pendientes y carpetas ya creadas. Vive solo en esta llamada, así
+        # dos corridas solapadas no se pisan el estado entre sí.
+        run = {
+            'snapshots': {
+                folder: self._snapshot_folder(folder)
+                for folder in {task['folder_path'] for task in tasks}
+            },
+            'futures': [],
+            'pending_heic': [],
+            'known_folders': set(),
+        }
+
+        # Pool de procesos compartido entre corridas para conversiones
+        # HEIC/PDF → JPG, para que no bloqueen a los hilos de descarga
+        self._ensure_conversion_pool()
+
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             # Crear futures para todas las tareas
             future_to_task = {
@@ -377,37 +611,116 @@ class EvidenciasDownloader:
                     self.download_single_file,
                     task['url'],
                     task['filename'],
-                    task['folder_path']
+                    task['folder_path'],
+                    run
                 ): task for task in tasks
             }
-            
+
             # Procesar completados
             for future in concurrent.futures.as_completed(future_to_task):
                 task = future_to_task[future]
                 try:
-                    result = future.result()
-                    if not result:
+                    task_stats = future.result()
+                    merged_stats.update(task_stats)
+                    if task_stats.get('failed'):
                         self.logger.error(f"❌ Falló descarga: {task['filename']}")
                 except Exception as e:
+                    merged_stats['failed'] += 1
                     self.logger.error(f"❌ Excepción en descarga: {task['filename']} - {e}")
 
+        # Conversión HEIC en lote: una sola llamada map al pool
+        if run['pending_heic'] and self._conversion_pool is not None:
+            self.logger.info(f"🔄 Convirtiendo {len(run['pending_heic'])} archivos HEIC en lote")
+            chunksize = max(1, len(run['pending_heic']) // ((os.cpu_count() or 1) * 4))
+            for file_path, error in self._conversion_pool.map(
+                    _convert_file_to_jpg, run['pending_heic'], chunksize=chunksize):
+                if error is None:
+                    merged_stats['converted'] += 1
+                    self.logger.info(f"🔄 Convertido a JPG: {os.path.basename(file_path)}")
+                else:
+                    merged_stats['conversion_failed'] += 1
+                    self.logger.error(f"❌ Error convirtiendo {file_path}: {error}")
+
+        # Esperar las conversiones pendientes del pool de procesos
+        if run['futures']:
+            self.logger.info(f"🔄 Esperando {len(run['futures'])} conversiones pendientes")
+            for future in concurrent.futures.as_completed(run['futures']):
+                try:
+                    file_path, error = future.result()
+                    if error is None:
+                        merged_stats['converted'] += 1
+                        self.logger.info(f"🔄 Convertido a JPG: {os.path.basename(file_path)}")
+                    else:
+                        merged_stats['conversion_failed'] += 1
+                        self.logger.error(f"❌ Error convirtiendo {file_path}: {error}")
+                except Exception as e:
+                    merged_stats['conversion_failed'] += 1
+                    self.logger.error(f"❌ Excepción en conversión: {e}")
+
+        # Materializar los destinos repetidos recién ahora, cuando el
+        # archivo fuente ya está descargado y (si aplicaba) convertido
+        for primary, task in duplicate_tasks:
+            merged_stats.update(self._materialize_duplicate(primary, task))
+
+        # Fusionar los contadores locales una sola vez al acumulado del
+        # proceso; el reporte por corrida usa el contador retornado
+        with self.lock:
+            for key, value in merged_stats.items():
+                self.download_stats[key] += value
+
+        return merged_stats
+
+    def _sniff_csv_format(self, file_path: str) -> Tuple[str, str]:
+        """Detecta encoding y delimitador del CSV con una sola lectura de muestra"""
+        sample_size = 65536
+        with open(file_path, 'rb') as f:
+            raw_sample = f.read(sample_size)
+        truncated = len(raw_sample) == sample_size
+
+        encoding = 'latin-1'
+        sample = raw_sample.decode('latin-1')
+        for candidate in ('utf-8-sig', 'cp1252'):
+            try:
+                sample = raw_sample.decode(candidate)
+                encoding = candidate
+                break
+            except UnicodeDecodeError as e:
+                # La muestra puede cortar un carácter multibyte justo en el
+                # límite de lectura; eso no significa que el archivo no sea
+                # UTF-8, así que se descarta el carácter incompleto y se
+                # reintenta antes de caer a cp1252
+                if truncated and e.start >= len(raw_sample) - 3:
+                    try:
+                        sample = raw_sample[:e.start].decode(candidate)
+                        encoding = candidate
+                        break
+                    except UnicodeDecodeError:
+                        pass
+                continue
+
+        first_line = sample.splitlines()[0] if sample else ''
+        delimiter = max([';', ',', '\t'], key=first_line.count)
+
+        return encoding, delimiter
+
     def read_file(self, file_path: str) -> Optional[pd.DataFrame]:
         """Lee un archivo CSV o Excel y retorna un DataFrame"""
         try:
             file_ext = os.path.splitext(file_path)[1].lower()
-            
+
             if file_ext == '.csv':
-                # Intentar diferentes delimitadores y encodings
-                for delimiter in [';', ',', '\t']:
-                    for encoding in ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252']:
-                        try:
-                            df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding)
-                            if len(df.columns) > 1:  # Verificar que se leyó correctamente
-                                self.logger.info(f"📄 CSV leído exitosamente: {os.path.basename(file_path)} ({len(df)} filas)")
-                                return df
-                        except Exception:
-                            continue
-                
+                # Una sola pasada de detección en lugar de probar las 12
+                # combinaciones delimitador × encoding
+                encoding, delimiter = self._sniff_csv_format(file_path)
+                try:
+                    # El engine pyarrow lee en paralelo y es mucho más rápido
+                    df = pd.read_csv(file_path, sep=delimiter, encoding=encoding, engine='pyarrow')
+                except (ImportError, ValueError):
+                    df = pd.read_csv(file_path, sep=delimiter, encoding=encoding)
+
+                self.logger.info(f"📄 CSV leído exitosamente: {os.path.basename(file_path)} ({len(df)} filas)")
+                return df
+
             elif file_ext in ['.xlsx', '.xls']:
                 try:
                     # Intentar leer Excel
@@ -483,39 +796,40 @@ class EvidenciasDownloader:
         # 🧵 Ejecutar descargas y mostrar estadísticas
         if all_tasks:
             start_time = datetime.now()
-            self.download_with_threads(all_tasks)
+            run_stats = self.download_with_threads(all_tasks)
             end_time = datetime.now()
-            self.print_final_stats(start_time, end_time, output_folder)
+            self.print_final_stats(start_time, end_time, output_folder, run_stats)
         else:
             self.logger.warning("⚠️ No se generaron tareas de descarga")
 
 
-    def print_final_stats(self, start_time: datetime, end_time: datetime, output_folder: str):
-        """Imprime estadísticas finales del proceso"""
+    def print_final_stats(self, start_time: datetime, end_time: datetime, output_folder: str, stats: Counter):
+        """Imprime estadísticas finales de la corrida (no del acumulado del proceso)"""
         duration = end_time - start_time
-        
+
         print("\n" + "="*60)
         print("📊 RESUMEN DE DESCARGA Y CONVERSIÓN")
         print("="*60)
         print(f"⏰ Tiempo total: {duration}")
         print(f"📁 Carpeta de salida: {output_folder}")
-        print(f"📊 Total de archivos procesados: {self.download_stats['total']}")
-        print(f"✅ Archivos descargados exitosamente: {self.download_stats['successful']}")
-        print(f"⏭️ Archivos omitidos (ya existían): {self.download_stats['skipped']}")
-        print(f"❌ Archivos con error: {self.download_stats['failed']}")
-        
+        print(f"📊 Total de archivos procesados: {stats['total']}")
+        print(f"✅ Archivos descargados exitosamente: {stats['successful']}")
+        print(f"⏭️ Archivos omitidos (ya existían): {stats['skipped']}")
+        print(f"❌ Archivos con error: {stats['failed']}")
+
         if self.convert_files:
-            print(f"🔄 Archivos convertidos a JPG: {self.download_stats['converted']}")
-            print(f"⚠️ Conversiones fallidas: {self.download_stats['conversion_failed']}")
-        
-        if self.download_stats['total'] > 0:
-            success_rate = (self.download_stats['successful'] / self.download_stats['total']) * 100
+            print(f"🔄 Archivos convertidos a JPG: {stats['converted']}")
+            print(f"⚠️ Conversiones fallidas: {stats['conversion_failed']}")
+
+        if stats['total'] > 0:
+            success_rate = (stats['successful'] / stats['total']) * 100
             print(f"📈 Tasa de éxito: {success_rate:.1f}%")
-        
+
         print("="*60)
 
+@functools.lru_cache(maxsize=1)
 def check_dependencies():
-    """Verifica que las dependencias necesarias estén instaladas"""
+    """Verifica que las dependencias necesarias estén instaladas (resultado cacheado)"""
     missing_deps = []
     
     try:
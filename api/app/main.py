@@ -1,121 +1,399 @@
-from fastapi import FastAPI, File, UploadFile, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, Request, Response, UploadFile, BackgroundTasks
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from downloader import EvidenciasDownloader, check_dependencies
 from pathlib import Path
+import anyio
+import concurrent.futures
+import hashlib
+import io
 import shutil
 import os
 import tempfile
+import time
 import zipfile
 import uuid
 
-app = FastAPI(title="Evidencias Downloader API", version="1.0")
+# orjson serializa las respuestas JSON (root, errores) bastante más
+# rápido que el encoder estándar
+app = FastAPI(title="Evidencias Downloader API", version="1.0",
+              default_response_class=ORJSONResponse)
+
+# Verificar dependencias y construir el descargador una sola vez al
+# importar el módulo, en lugar de repetirlo en cada request.
+# Hilos de descarga: escalan con los núcleos reales (I/O-bound, de ahí el
+# 4x) y EVID_WORKERS permite fijarlos a mano; el constructor aplica el
+# mismo techo por si el valor viene desmedido.
+DEPS_OK = check_dependencies()
+_WORKERS = int(os.getenv("EVID_WORKERS", str(min(32, (os.cpu_count() or 1) * 4))))
+downloader = EvidenciasDownloader(max_workers=_WORKERS, convert_files=DEPS_OK)
+
+
+@app.on_event("shutdown")
+def _shutdown_downloader():
+    """Libera el pool de conversión compartido al apagar el servicio"""
+    downloader.close()
+
+
+class _ZipStreamWriter(io.RawIOBase):
+    """Buffer de solo escritura que acumula los bytes que produce ZipFile"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        """Entrega lo acumulado hasta ahora y vacía el buffer"""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+# Capacidad mínima del tmpfs para usarlo como scratch: el árbol de
+# salida con las imágenes convertidas vive ahí durante el streaming, y
+# el /dev/shm de 64 MiB que Docker monta por defecto se llena con
+# cualquier lote real (las descargas morirían una a una con ENOSPC)
+_MIN_SHM_BYTES = 1024 * 1024 * 1024
+
+
+def _scratch_base() -> str:
+    """
+    Directorio base para los árboles temporales de cada request.
+    Se prefiere un filesystem respaldado por RAM (tmpfs) cuando existe y
+    tiene capacidad real (ver --shm-size en el despliegue), así los
+    archivos intermedios nunca tocan el disco del contenedor; si el tmpfs
+    es chico se cae al disco en lugar de llenarlo a mitad de corrida.
+    EVIDENCIAS_SCRATCH_DIR permite forzar otra ubicación.
+    """
+    override = os.getenv("EVIDENCIAS_SCRATCH_DIR")
+    if override:
+        return override
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        try:
+            if shutil.disk_usage("/dev/shm").total >= _MIN_SHM_BYTES:
+                return "/dev/shm"
+        except OSError:
+            pass
+    return tempfile.gettempdir()
+
+
+_SCRATCH_BASE = _scratch_base()
+
+
+# Buffer grande para volcar subidas: menos iteraciones Python y menos
+# syscalls que el COPY_BUFSIZE de 64 KiB por defecto en Linux
+_UPLOAD_BUFSIZE = max(shutil.COPY_BUFSIZE, 1024 * 1024)
+
+# Tope por archivo subido: las planillas de evidencias son de unos pocos
+# MB, así que 100 MiB ya indica un payload anómalo
+_MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+
+# Tope del cuerpo completo de la petición (todas las partes más la
+# sobrecarga del multipart): más holgado que el tope por archivo para no
+# rechazar lotes legítimos de varias planillas
+_MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(10 * _MAX_UPLOAD_BYTES)))
+
+
+def _persist_upload(file: UploadFile, destination: Path, oversized: list, digests: dict) -> None:
+    """
+    Copia el archivo subido a disco por bloques, contando los bytes y
+    acumulando el hash de contenido sobre la marcha; si excede el tope se
+    corta la copia y se registra el nombre en lugar de seguir consumiendo
+    el cuerpo (se ejecuta en el threadpool).
+    """
+    written = 0
+    # blake2b rinde bastante más que SHA-2 en software y alcanza de sobra
+    # como hash de contenido
+    digest = hashlib.blake2b(digest_size=32)
+    with open(destination, "wb") as f:
+        while True:
+            chunk = file.file.read(_UPLOAD_BUFSIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > _MAX_UPLOAD_BYTES:
+                oversized.append(destination.name)
+                return
+            digest.update(chunk)
+            f.write(chunk)
+    digests[destination.name] = digest.hexdigest()
+
+
+def _combined_etag(digests: dict) -> str:
+    """ETag determinista para el conjunto de archivos subidos"""
+    combined = hashlib.blake2b(digest_size=32)
+    for name in sorted(digests):
+        combined.update(name.encode())
+        combined.update(digests[name].encode())
+    return f'"{combined.hexdigest()}"'
+
+
+def _iter_dir_entries(directory: str, prefix: str = ""):
+    """
+    Recorre el árbol con scandir entregando (entry, arcname); el stat
+    viene cacheado en el DirEntry, sin syscalls extra por archivo.
+    Iterativo con pila explícita: sin generadores anidados por nivel.
+    """
+    stack = [(directory, prefix)]
+    while stack:
+        current, current_prefix = stack.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, f"{current_prefix}{entry.name}/"))
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry, f"{current_prefix}{entry.name}"
+
+
+# Nivel 1 cuando se usa deflate: en este endpoint el cuello es CPU y los
+# niveles altos casi no reducen más un payload de imágenes
+_DEFLATE_LEVEL = 1
+
+# Método de compresión opt-in vía ZIP_COMPRESSION: las imágenes viajan
+# mejor STORED (default), pero salidas con mucho texto pueden activar
+# deflated/bzip2/lzma por entorno
+_COMPRESSION_METHODS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+_ZIP_COMPRESSION = _COMPRESSION_METHODS.get(
+    os.getenv("ZIP_COMPRESSION", "stored").lower(), zipfile.ZIP_STORED
+)
+
+# Solo se leen por adelantado archivos acotados; los grandes se copian
+# por bloques para no acumularlos enteros en memoria
+_PREFETCH_LIMIT = 8 * 1024 * 1024
+
+# Bloques de 1 MiB hacia el ZIP: el CRC32 lo calcula zlib en C (slice-by-N),
+# así que lo único que pesa es el loop Python alrededor; bloques grandes
+# lo amortizan sin necesidad de un CRC acelerado aparte
+_ZIP_BLOCK = 1024 * 1024
+
+
+def _read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def iter_zip_stream(source_dir: Path, compression: int = _ZIP_COMPRESSION):
+    """
+    Genera el ZIP sobre la marcha, entregando los bytes de cada entrada
+    apenas se escriben, sin materializar el archivo en disco.
+    """
+    buffer = _ZipStreamWriter()
+    # Un solo buffer de lectura reutilizado para todas las entradas.
+    # sendfile() no aplica aquí (el destino es la respuesta ASGI, no un fd),
+    # así que se minimizan las copias en espacio de usuario con readinto.
+    read_buffer = memoryview(bytearray(_ZIP_BLOCK))
+
+    # allowZip64 explícito: las corridas grandes superan los 4 GiB sin drama
+    with zipfile.ZipFile(buffer, "w", compression, allowZip64=True, compresslevel=_DEFLATE_LEVEL) as zipf, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+
+        def stage(item):
+            """Anota el stat y lanza la lectura anticipada del archivo"""
+            entry, arcname = item
+            stat_result = entry.stat()
+            future = None
+            if stat_result.st_size <= _PREFETCH_LIMIT:
+                future = prefetcher.submit(_read_file_bytes, entry.path)
+            return entry, arcname, stat_result, future
+
+        # Pipeline de profundidad 1: mientras se transmite la entrada
+        # actual, el prefetcher ya está leyendo la siguiente
+        iterator = _iter_dir_entries(str(source_dir))
+        pending = next(iterator, None)
+        staged = stage(pending) if pending is not None else None
+
+        while staged is not None:
+            entry, arcname, stat_result, future = staged
+            pending = next(iterator, None)
+            staged = stage(pending) if pending is not None else None
+
+            # ZipInfo construido desde el stat cacheado: evita que
+            # zipf.write repita el stat de cada archivo
+            info = zipfile.ZipInfo(arcname, date_time=time.localtime(stat_result.st_mtime)[:6])
+            info.external_attr = (stat_result.st_mode & 0xFFFF) << 16
+            info.file_size = stat_result.st_size
+            info.compress_type = compression
+            info._compresslevel = _DEFLATE_LEVEL
+
+            with zipf.open(info, "w") as dest:
+                if future is not None:
+                    data = memoryview(future.result())
+                    for offset in range(0, len(data), _ZIP_BLOCK):
+                        dest.write(data[offset:offset + _ZIP_BLOCK])
+                        yield buffer.take()
+                else:
+                    # Archivo grande: copiar por bloques con lectura cruda
+                    with open(entry.path, "rb", buffering=0) as src:
+                        while True:
+                            read = src.readinto(read_buffer)
+                            if not read:
+                                break
+                            dest.write(read_buffer[:read])
+                            yield buffer.take()
+            yield buffer.take()
+    # Directorio central del ZIP, escrito al cerrar
+    yield buffer.take()
+
+
+def _stream_zip_and_cleanup(source_dir: Path):
+    """
+    Envuelve iter_zip_stream garantizando la limpieza del árbol aunque el
+    streaming falle a mitad de camino: si el generador levanta, Starlette
+    nunca ejecuta la tarea en background y el árbol quedaría vivo en
+    /dev/shm. El rmtree es idempotente con el de la tarea en background.
+    """
+    try:
+        yield from iter_zip_stream(source_dir)
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+
+
+# Lista concreta de orígenes vía ALLOWED_ORIGINS (separados por coma),
+# p.ej. el dominio de Apps Script. El comodín no admite credenciales,
+# así que allow_credentials solo se activa con lista explícita.
+_ALLOWED_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",")
+    if origin.strip()
+]
+
+# Registrado ANTES que CORSMiddleware a propósito: el último middleware
+# agregado queda más afuera, y CORS debe envolver al tope de cuerpo para
+# que sus 413 lleguen con Access-Control-Allow-Origin al cliente
+@app.middleware("http")
+async def _reject_oversized_bodies(request: Request, call_next):
+    """
+    Rechaza por Content-Length ANTES de que FastAPI parsee el multipart:
+    el chequeo por archivo en _persist_upload corta la copia, pero para
+    entonces el cuerpo completo ya fue volcado al spool del formulario.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            if int(content_length) > _MAX_BODY_BYTES:
+                return ORJSONResponse(
+                    status_code=413,
+                    content={"error": f"El cuerpo de la petición excede el máximo de {_MAX_BODY_BYTES} bytes"}
+                )
+        except ValueError:
+            pass
+    return await call_next(request)
+
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # O puedes restringirlo a tu dominio Apps Script
-    allow_credentials=True,
+    allow_origins=_ALLOWED_ORIGINS,
+    allow_credentials=_ALLOWED_ORIGINS != ["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-@app.post("/process")
-async def process_files(
-    files: list[UploadFile] = File(...),
-    background_tasks: BackgroundTasks = None
-):
+async def _process_uploads(request: Request, files: list[UploadFile], background_tasks: BackgroundTasks):
     """
-    Recibe uno o varios archivos CSV/Excel,
-    procesa las evidencias y devuelve un ZIP descargable.
+    Flujo compartido de /process y /process-folder: guarda los archivos
+    subidos, procesa las evidencias y transmite el ZIP resultante.
     """
     session_id = str(uuid.uuid4())
-    input_dir = Path(tempfile.mkdtemp(prefix=f"input_{session_id}_"))
-    output_dir = Path(tempfile.mkdtemp(prefix=f"output_{session_id}_"))
+    input_dir = Path(tempfile.mkdtemp(prefix=f"input_{session_id}_", dir=_SCRATCH_BASE))
+    output_dir = Path(tempfile.mkdtemp(prefix=f"output_{session_id}_", dir=_SCRATCH_BASE))
 
     try:
-        # Guardar archivos subidos
-        for file in files:
-            file_path = input_dir / file.filename
-            with open(file_path, "wb") as f:
-                shutil.copyfileobj(file.file, f)
-
-        # Inicializar descargador
-        deps_ok = check_dependencies()
-        downloader = EvidenciasDownloader(max_workers=6, convert_files=deps_ok)
-
-        # Procesar archivos en input_dir y guardar en output_dir
-        downloader.process_folder(str(input_dir), str(output_dir))
-
-        # Crear ZIP del output_dir
-        zip_path = Path(tempfile.gettempdir()) / f"resultados_{session_id}.zip"
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files_in_dir in os.walk(output_dir):
-                for file in files_in_dir:
-                    file_path = Path(root) / file
-                    arcname = file_path.relative_to(output_dir)
-                    zipf.write(file_path, arcname)
+        # Guardar archivos subidos en paralelo, cada copia en el threadpool.
+        # El nombre lo manda el cliente: quedarse solo con el nombre base
+        # (nada de rutas absolutas ni "..", que escaparían del scratch) y
+        # desambiguar homónimos para que dos partes con el mismo nombre no
+        # escriban concurrentemente sobre la misma ruta
+        oversized: list = []
+        digests: dict = {}
+        used_names: set = set()
+        async with anyio.create_task_group() as tg:
+            for file in files:
+                safe_name = Path(file.filename or "").name or "archivo"
+                stem, ext = os.path.splitext(safe_name)
+                suffix = 1
+                while safe_name in used_names:
+                    safe_name = f"{stem}_{suffix}{ext}"
+                    suffix += 1
+                used_names.add(safe_name)
+                tg.start_soon(anyio.to_thread.run_sync, _persist_upload, file, input_dir / safe_name, oversized, digests)
+
+        if oversized:
+            shutil.rmtree(input_dir, ignore_errors=True)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return ORJSONResponse(
+                status_code=413,
+                content={"error": f"Archivos que exceden el máximo de {_MAX_UPLOAD_BYTES} bytes: {', '.join(oversized)}"}
+            )
+
+        # Mismo conjunto de archivos ya pedido antes → 304 sin reprocesar
+        etag = _combined_etag(digests)
+        if request.headers.get("if-none-match") == etag:
+            shutil.rmtree(input_dir, ignore_errors=True)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return Response(status_code=304, headers={"ETag": etag})
+
+        # Procesar archivos en input_dir y guardar en output_dir.
+        # process_folder es síncrono (hilos + pool de procesos internos):
+        # al threadpool, para no congelar el event loop durante minutos
+        await anyio.to_thread.run_sync(downloader.process_folder, str(input_dir), str(output_dir))
+
+        # El árbol de entrada ya cumplió su función: eliminarlo ahora evita
+        # mantener dos árboles vivos mientras se transmite el ZIP. El de
+        # salida sí debe sobrevivir hasta que termine el streaming.
+        shutil.rmtree(input_dir, ignore_errors=True)
 
         # Programar limpieza automática después de enviar respuesta
-        if background_tasks:
-            background_tasks.add_task(shutil.rmtree, input_dir, ignore_errors=True)
-            background_tasks.add_task(shutil.rmtree, output_dir, ignore_errors=True)
-            background_tasks.add_task(os.remove, zip_path)
-
-        # Devolver el ZIP correcto
-        return FileResponse(
-            path=zip_path,
+        background_tasks.add_task(shutil.rmtree, output_dir, ignore_errors=True)
+
+        # Transmitir el ZIP directo a la respuesta, sin archivo intermedio
+        return StreamingResponse(
+            _stream_zip_and_cleanup(output_dir),
             media_type="application/zip",
-            filename="resultados.zip"
+            headers={
+                "Content-Disposition": 'attachment; filename="resultados.zip"',
+                "ETag": etag,
+            }
         )
 
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+        # No habrá respuesta que esperar: limpiar ambos árboles ya mismo
+        shutil.rmtree(input_dir, ignore_errors=True)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return ORJSONResponse(status_code=500, content={"error": str(e)})
+
+@app.post("/process")
+async def process_files(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    files: list[UploadFile] = File(...)
+):
+    """
+    Recibe uno o varios archivos CSV/Excel,
+    procesa las evidencias y devuelve un ZIP descargable.
+    """
+    return await _process_uploads(request, files, background_tasks)
 
 @app.post("/process-folder")
 async def process_folder_endpoint(
-    files: list[UploadFile] = File(...),
-    background_tasks: BackgroundTasks = None
+    request: Request,
+    background_tasks: BackgroundTasks,
+    files: list[UploadFile] = File(...)
 ):
     """
     Recibe varios archivos (CSV o Excel) y devuelve un ZIP con todas las descargas procesadas.
     """
-    session_id = str(uuid.uuid4())
-    input_dir = Path(tempfile.mkdtemp(prefix=f"input_{session_id}_"))
-    output_dir = Path(tempfile.mkdtemp(prefix=f"output_{session_id}_"))
-
-    try:
-        # Guardar archivos subidos
-        for file in files:
-            file_path = input_dir / file.filename
-            with open(file_path, "wb") as f:
-                shutil.copyfileobj(file.file, f)
-
-        deps_ok = check_dependencies()
-        downloader = EvidenciasDownloader(max_workers=6, convert_files=deps_ok)
-
-        # Aquí está la clave ⚠️
-        # En lugar de usar un INPUT_FOLDER global, usamos input_dir real
-        downloader.process_folder(str(input_dir), str(output_dir))
-
-        # Crear ZIP con resultados
-        zip_path = Path(tempfile.gettempdir()) / f"resultados_{session_id}.zip"
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(output_dir):
-                for file in files:
-                    file_path = Path(root) / file
-                    arcname = file_path.relative_to(output_dir)
-                    zipf.write(file_path, arcname)
-
-        # Limpieza en background
-        if background_tasks:
-            background_tasks.add_task(shutil.rmtree, input_dir, ignore_errors=True)
-            background_tasks.add_task(shutil.rmtree, output_dir, ignore_errors=True)
-            background_tasks.add_task(os.remove, zip_path)
-
-        return FileResponse(zip_path, media_type="application/zip", filename="resultados.zip")
-
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+    return await _process_uploads(request, files, background_tasks)
 
 @app.get("/")
 def root():